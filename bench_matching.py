@@ -0,0 +1,69 @@
+import time
+import numpy as np
+from matching import TradeMatcher
+
+
+USER_COUNT = 100_000
+APP_COUNT = 20_000
+HAVES_PER_USER = 60
+WANTS_PER_USER = 15
+QUERY_COUNT = 1_000
+UPDATE_COUNT = 1_000
+
+
+def random_apps(rng, popularity, count):
+    return rng.choice(APP_COUNT, size=count, replace=False, p=popularity).tolist()
+
+
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return f'p50 {np.percentile(timings, 50):.2f} ms, p99 {np.percentile(timings, 99):.2f} ms, max {timings.max():.2f} ms'
+
+
+def main():
+    rng = np.random.default_rng(0)
+    # game ownership is heavily skewed towards a few popular titles
+    popularity = 1 / np.arange(1, APP_COUNT + 1) ** 0.8
+    popularity /= popularity.sum()
+
+    users = [{
+        'steam_id': str(76561190000000000 + i),
+        'games': [{'app_id': app_id} for app_id in random_apps(rng, popularity, HAVES_PER_USER)],
+        'wants': random_apps(rng, popularity, WANTS_PER_USER),
+    } for i in range(USER_COUNT)]
+
+    matcher = TradeMatcher()
+    start = time.perf_counter()
+    matcher.load(users)
+    print(f'load {USER_COUNT} users: {time.perf_counter() - start:.2f} s')
+
+    arrays = matcher._haves + matcher._wants + list(matcher._owners.values()) + list(matcher._wanters.values())
+    print(f'index arrays: {sum(array.nbytes for array in arrays) / 2 ** 20:.1f} MB')
+
+    query_ids = rng.choice(USER_COUNT, size=QUERY_COUNT, replace=False)
+    timings = []
+    for i in query_ids:
+        start = time.perf_counter()
+        matcher.best_partners(users[i]['steam_id'], 10)
+        timings.append(time.perf_counter() - start)
+    print(f'best_partners: {percentiles(timings)}')
+
+    timings = []
+    for i in rng.choice(USER_COUNT, size=UPDATE_COUNT, replace=False):
+        haves = random_apps(rng, popularity, HAVES_PER_USER)
+        wants = random_apps(rng, popularity, WANTS_PER_USER)
+        start = time.perf_counter()
+        matcher.update_user(users[i]['steam_id'], haves, wants)
+        timings.append(time.perf_counter() - start)
+    print(f'update_user: {percentiles(timings)}')
+
+    timings = []
+    for i in query_ids:
+        start = time.perf_counter()
+        matcher.best_partners(users[i]['steam_id'], 10)
+        timings.append(time.perf_counter() - start)
+    print(f'best_partners (after updates): {percentiles(timings)}')
+
+
+if __name__ == '__main__':
+    main()
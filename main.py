@@ -1,14 +1,18 @@
 import datetime
+import re
+import time
 from flask import Flask, Response, request, make_response, jsonify, render_template, redirect
 from decouple import config
 from steam import Steam
 from pysteamsignin.steamsignin import SteamSignIn
-import requests
 from multiprocessing import Pool
 import pymongo
 from concurrent.futures import ThreadPoolExecutor
 import threading
 from bson import ObjectId
+from matching import TradeMatcher, user_haves
+from recommendations import update_recommendations
+from upstream import Upstream, UpstreamBusyError, UpstreamError
 
 
 app = Flask(__name__, template_folder='html', static_folder='css')
@@ -19,6 +23,22 @@ steam = Steam(KEY)
 mongodb = pymongo.MongoClient(config("MONGO_URI"))
 database = mongodb.game_shifters
 
+# kept in this process only, the site is expected to run as a single process
+trade_matcher = TradeMatcher()
+
+# how often the homepage recommendations are rebuilt, in seconds
+RECOMMENDATIONS_INTERVAL = config("RECOMMENDATIONS_INTERVAL", default=3600, cast=int)
+
+UPSTREAM_TIMEOUT = config("UPSTREAM_TIMEOUT", default=5, cast=float)
+UPSTREAM_CONCURRENCY = config("UPSTREAM_CONCURRENCY", default=8, cast=int)
+
+# every remote host gets its own breaker and concurrency budget
+steam_api = Upstream('steam_api', UPSTREAM_TIMEOUT, UPSTREAM_CONCURRENCY)
+steam_store = Upstream('steam_store', UPSTREAM_TIMEOUT, UPSTREAM_CONCURRENCY)
+steam_community = Upstream('steam_community', UPSTREAM_TIMEOUT, UPSTREAM_CONCURRENCY)
+steamspy = Upstream('steamspy', UPSTREAM_TIMEOUT, UPSTREAM_CONCURRENCY)
+upstreams = [steam_api, steam_store, steam_community, steamspy]
+
 def format_time_ago(message_timestamp):
     current_time = datetime.datetime.now()
     time_difference = current_time - message_timestamp
@@ -49,22 +69,113 @@ def run_in_subprocess(func, process_count=8):
         pool.map(func, range(process_count))
 
 
-def get_avatar_url(steam_id):
-    return steam.users.get_user_details(steam_id)['player']['avatarfull']
+def refresh_recommendations():
+    # runs in every process, like the trade matcher the site assumes a single one
+    while True:
+        try:
+            update_recommendations()
+        except Exception as e:
+            print(e)
+        time.sleep(RECOMMENDATIONS_INTERVAL)
 
+TRADE_MATCHER_FIELDS = {'_id': 0, 'steam_id': 1, 'games.app_id': 1, 'wants': 1, 'traded_in': 1, 'traded_out': 1}
 
-def update_top_games():
-    recommended_games = []
-    recommended_games_json = requests.get('https://steamspy.com/api.php?request=top100in2weeks').json()
-    game_ids = list(recommended_games_json.keys())
+def load_trade_matcher():
+    # keep retrying, /trade_partners answers 503 and updates stay queued until it loads
+    while not trade_matcher.loaded:
+        try:
+            trade_matcher.load(database.users.find({}, TRADE_MATCHER_FIELDS))
+        except Exception as e:
+            print(f'Failed to load trade matcher: {e}')
+            time.sleep(30)
 
-    for game_id in game_ids[:26]:
-        game_data = get_app_data(game_id)
-        if game_data:
-            recommended_games.append(game_data)
+def sync_trade_matcher(steam_id):
+    user_data = database.users.find_one({'steam_id': steam_id}, TRADE_MATCHER_FIELDS)
+
+    if user_data is None:
+        trade_matcher.remove_user(steam_id)
+        return
+
+    trade_matcher.update_user(steam_id, user_haves(user_data), user_data.get('wants', []))
+
+def record_trade(steam_id, given, received):
+    user_data = database.users.find_one({'steam_id': steam_id}, {'_id': 0, 'traded_in': 1, 'traded_out': 1})
+
+    if user_data is None:
+        return
 
-    database.top_games.drop()
-    database.top_games.insert_many(recommended_games)
+    traded_in = set(user_data.get('traded_in', []))
+    traded_out = set(user_data.get('traded_out', []))
+
+    for app_id in given:
+        if app_id in traded_in:
+            traded_in.discard(app_id)
+        else:
+            traded_out.add(app_id)
+
+    for app_id in received:
+        if app_id in traded_out:
+            traded_out.discard(app_id)
+        else:
+            traded_in.add(app_id)
+
+    # nobody wants a game they have just received
+    database.users.update_one(
+        {'steam_id': steam_id},
+        {
+            '$set': {'traded_in': sorted(traded_in), 'traded_out': sorted(traded_out)},
+            '$pull': {'wants': {'$in': list(received)}}
+        }
+    )
+    sync_trade_matcher(steam_id)
+
+def parse_app_ids(values):
+    # returns None if any of the values is not an app_id
+    try:
+        return [int(value) for value in values]
+    except ValueError:
+        return None
+
+
+def steam_api_get(path, **params):
+    # called directly instead of through the steam library, which sets no socket timeout
+    params['key'] = KEY
+    return steam_api.get_json(f'https://api.steampowered.com{path}', params)['response']
+
+def get_json_queued(upstream, url, attempts=3):
+    # a busy host only means other lookups are ahead of us, a busy host whose budget
+    # is held by hung calls opens its breaker and the next attempt fails fast
+    for attempt in range(attempts):
+        try:
+            return upstream.get_json(url, acquire_timeout=UPSTREAM_TIMEOUT)
+        except UpstreamBusyError:
+            if attempt == attempts - 1:
+                raise
+
+def get_user_details(steam_id):
+    if steam_id is None:
+        return {'personaname': None, 'avatarfull': None}
+
+    try:
+        return steam_api_get('/ISteamUser/GetPlayerSummaries/v2/', steamids=steam_id)['players'][0]
+    except UpstreamError as e:
+        print(e)
+    except IndexError:
+        print(f'Steam has no profile for {steam_id}')
+
+    # fall back to the profile stored at the last successful sync
+    user_data = database.users.find_one({'steam_id': steam_id}, {'_id': 0, 'username': 1, 'avatar': 1})
+    if user_data is None:
+        return {'personaname': None, 'avatarfull': None, 'stale': True}
+
+    return {'personaname': user_data['username'], 'avatarfull': user_data['avatar'], 'stale': True}
+
+
+def get_recommendations(steam_id):
+    # both documents are precomputed by recommendations.py
+    documents = database.recommendations.find({'_id': {'$in': ['most_offered', steam_id]}})
+    documents = {document['_id']: document['games'] for document in documents}
+    return documents.get(steam_id, []), documents.get('most_offered', [])
 
 @app.route('/')
 def main():
@@ -73,16 +184,15 @@ def main():
     if not steam_id:
         return render_template('index.html')
 
-    # TODO: Run periodically
-    update_top_games()
-
-    top_games = list(database.top_games.find({}))
+    trade_games, top_games = get_recommendations(steam_id)
 
-    user = steam.users.get_user_details(steam_id)['player']
+    user = get_user_details(steam_id)
     return render_template(
         'index_logged_in.html',
         username=user['personaname'],
         avatar=user['avatarfull'],
+        profile_stale=user.get('stale', False),
+        trade_games=trade_games,
         top_games=top_games
     )
 
@@ -125,11 +235,11 @@ def get_app_data(app_id):
             app['users'] = users
             return app
         
-        steamspy_data = requests.get(f'https://steamspy.com/api.php?request=appdetails&appid={app_id}').json()
+        steamspy_data = get_json_queued(steamspy, f'https://steamspy.com/api.php?request=appdetails&appid={app_id}')
         score = steamspy_data['positive'] / (steamspy_data['positive'] + steamspy_data['negative']) * 10
 
         app_data = None
-        app_data_response = requests.get(f'http://store.steampowered.com/api/appdetails?appids={app_id}&lang=en').json()
+        app_data_response = get_json_queued(steam_store, f'http://store.steampowered.com/api/appdetails?appids={app_id}&lang=en')
 
         if app_data_response[str(app_id)]['success']:
             app_data = app_data_response[str(app_id)]['data']
@@ -163,16 +273,36 @@ def get_app_data(app_id):
 def update_user_data(steam_id):
     user_data = database.users.find_one({'steam_id': steam_id})
 
-    user = steam.users.get_user_details(steam_id)['player']
-    steam_level = steam.users.get_user_steam_level(steam_id)
-    owned_games = steam.users.get_owned_games(steam_id)['games']
+    try:
+        players = steam_api_get('/ISteamUser/GetPlayerSummaries/v2/', steamids=steam_id)['players']
+        if not players:
+            print(f'Steam has no profile for {steam_id}')
+            return user_data is not None
+
+        user = players[0]
+        steam_level = steam_api_get('/IPlayerService/GetSteamLevel/v1/', steamid=steam_id)
+        owned_games = steam_api_get(
+            '/IPlayerService/GetOwnedGames/v1/',
+            steamid=steam_id,
+            include_appinfo='true',
+            include_played_free_games='true'
+        )['games']
+    except UpstreamError as e:
+        print(e)
+        # keep the last synced profile and library, only a new user cannot log in
+        return user_data is not None
 
     ids = [game['appid'] for game in owned_games]
 
-    with ThreadPoolExecutor() as executor:
+    # no more threads than the upstreams will serve at once
+    with ThreadPoolExecutor(UPSTREAM_CONCURRENCY) as executor:
         # Use executor.map to parallelize the get_app_data calls
         games = list(executor.map(get_app_data, ids))
 
+    # keep the previously stored entry for games whose data could not be fetched now
+    previous_games = {game['app_id']: game for game in user_data['games']} if user_data else {}
+    games = [game or previous_games.get(app_id) for app_id, game in zip(ids, games)]
+
     # remove None values
     games = [game for game in games if game]
     
@@ -186,7 +316,10 @@ def update_user_data(steam_id):
             'rating_count': 0,
             'star_ratings': [0, 0, 0, 0, 0],
             'comments': [],
-            'games': games
+            'games': games,
+            'wants': [],
+            'traded_in': [],
+            'traded_out': []
         })
     else:
         database.users.update_one(
@@ -195,21 +328,32 @@ def update_user_data(steam_id):
                 'username': user['personaname'],
                 'avatar': user['avatarfull'],
                 'steam_level': steam_level['player_level'],
-                'games': games
+                'games': games,
+                # the fresh library already reflects completed trades
+                'traded_in': [],
+                'traded_out': []
             }}
         )
 
+    sync_trade_matcher(steam_id)
+    return True
+
 @app.route('/processlogin')
 def process():
     returnData = request.values
     steamLogin = SteamSignIn()
-    steam_id = steamLogin.ValidateResults(returnData)
+    try:
+        steam_id = steam_community.call(steamLogin.ValidateResults, returnData)
+    except UpstreamError as e:
+        print(e)
+        steam_id = None
 
     if not steam_id:
         return 'Failed to log in'
 
     # TODO: Run in subprocess
-    update_user_data(steam_id)
+    if not update_user_data(steam_id):
+        return 'Steam is unavailable right now, please try again later'
 
     response = make_response(redirect('/'))
     response.set_cookie('steam_id', steam_id, secure=True)
@@ -221,12 +365,21 @@ def search():
     if query is None:
         query = ''
 
-    # IMPORTANT: I have edited the steam library
-    res = steam.apps.search_games(query)['apps']
-    ids = [r['id'] for r in res]
+    stale = False
+    try:
+        # IMPORTANT: I have edited the steam library
+        res = steam_store.call(steam.apps.search_games, query)['apps']
+        ids = [r['id'] for r in res]
+    except UpstreamError as e:
+        print(e)
+        # search the games we already know about instead
+        stale = True
+        res = database.apps.find({'name': {'$regex': re.escape(query), '$options': 'i'}}, {'_id': 0, 'app_id': 1}).limit(25)
+        ids = [r['app_id'] for r in res]
 
     games = []
-    with ThreadPoolExecutor() as executor:
+    # no more threads than the upstreams will serve at once
+    with ThreadPoolExecutor(UPSTREAM_CONCURRENCY) as executor:
         # Use executor.map to parallelize the get_app_data calls
         game_data_list = list(executor.map(get_app_data, ids))
 
@@ -235,19 +388,38 @@ def search():
             games.append(game_data)
 
     steam_id = request.cookies.get('steam_id')
+    user = get_user_details(steam_id)
     return render_template(
         'search.html',
-        avatar=get_avatar_url(steam_id),
+        avatar=user['avatarfull'],
+        profile_stale=user.get('stale', False),
         query=query,
         games=games,
+        stale=stale,
     )
 
+@app.route('/upstream_status')
+def upstream_status():
+    # monitoring only, not exposed to visitors
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return Response('Forbidden', status=403)
+
+    return jsonify({upstream.name: upstream.snapshot() for upstream in upstreams})
+
 @app.route('/get_owned_games')
 def get_owned_games():
     steam_id = request.cookies.get('steam_id')
 
     if steam_id is not None:
-        owned_games = steam.users.get_owned_games(steam_id)
+        try:
+            owned_games = steam_api_get(
+                '/IPlayerService/GetOwnedGames/v1/',
+                steamid=steam_id,
+                include_appinfo='true',
+                include_played_free_games='true'
+            )
+        except UpstreamError:
+            return Response('Steam is unavailable right now', status=503)
         return jsonify({"owned_games": owned_games})
     else:
         return 'Please <a href="/?login=true">log in</a>'
@@ -258,6 +430,7 @@ def delete_account():
 
     if steam_id is not None:
         database.users.delete_one({'steam_id': steam_id})
+        trade_matcher.remove_user(steam_id)
         response = make_response(redirect('/'))
         response.set_cookie('steam_id', '', expires=0)
         return response
@@ -423,13 +596,76 @@ def game():
 
     if game_id is None:
         raise Exception('PAGE NOT FOUND')
+
+    if not game_id.isdigit():
+        return make_response('Invalid game id', 400)
     
     game_data = get_app_data(game_id)
+    wanted = database.users.find_one({'steam_id': steam_id, 'wants': int(game_id)}, {'_id': 1}) is not None
+    user = get_user_details(steam_id)
     return render_template(
         'game.html',
-        avatar=get_avatar_url(steam_id),
-        game=game_data
+        avatar=user['avatarfull'],
+        profile_stale=user.get('stale', False),
+        game=game_data,
+        wanted=wanted
+    )
+
+@app.route('/want')
+def want():
+    steam_id = request.cookies.get('steam_id')
+
+    if steam_id is None:
+        return redirect('/')
+
+    game_id = request.args.get('id')
+
+    if game_id is None:
+        return make_response('Game not specified', 400)
+
+    if not game_id.isdigit():
+        return make_response('Invalid game id', 400)
+
+    if request.args.get('remove'):
+        database.users.update_one({'steam_id': steam_id}, {'$pull': {'wants': int(game_id)}})
+    else:
+        database.users.update_one({'steam_id': steam_id}, {'$addToSet': {'wants': int(game_id)}})
+
+    sync_trade_matcher(steam_id)
+    return redirect(f'/game?id={game_id}')
+
+@app.route('/trade_partners')
+def trade_partners():
+    steam_id = request.cookies.get('steam_id')
+
+    if steam_id is None:
+        return Response('Not logged in', status=401)
+
+    k = request.args.get('k', '10')
+
+    if not k.isdigit():
+        return Response('Invalid k', status=400)
+
+    if not trade_matcher.loaded:
+        return Response('Trade matching is still loading', status=503)
+
+    k = max(1, min(int(k), 100))
+    partners = trade_matcher.best_partners(steam_id, k)
+
+    users = database.users.find(
+        {'steam_id': {'$in': [partner['steam_id'] for partner in partners]}},
+        {'_id': 0, 'steam_id': 1, 'username': 1, 'avatar': 1}
     )
+    users = {user['steam_id']: user for user in users}
+
+    for partner in partners:
+        user = users.get(partner['steam_id'], {})
+        partner['username'] = user.get('username')
+        partner['avatar'] = user.get('avatar')
+
+    return jsonify({
+        'partners': partners,
+    })
 
 @app.route('/messages')
 def messages():
@@ -650,6 +886,7 @@ def change_trade_status():
         elif command == 'cancel':
             trade['cancelled'] = True
         elif command == 'complete':
+            was_completed = trade['completed']
             if trade['initiator_id'] == steam_id:
                 trade['initiator_completed'] = True
             else:
@@ -658,6 +895,14 @@ def change_trade_status():
                 trade['completed'] = True
 
         database.trades.update_one({'_id': ObjectId(trade_id)}, {'$set': trade})
+
+        if command == 'complete' and trade['completed'] and not was_completed:
+            initiator_games = trade.get('initiator_games', [])
+            user_games = trade.get('user_games', [])
+
+            # kept on both users until their next Steam sync
+            record_trade(trade['initiator_id'], initiator_games, user_games)
+            record_trade(trade['user_id'], user_games, initiator_games)
         return 'OK'
     except Exception as e:
         return Response('Failed to change trade status', status=500)
@@ -674,9 +919,28 @@ def trade():
     if user_id is None:
         return make_response('User not specified', 400)
 
+    # the games each side hands over, e.g. the offer/receive lists from /trade_partners
+    initiator_games = parse_app_ids(request.args.getlist('give'))
+    user_games = parse_app_ids(request.args.getlist('receive'))
+
+    if initiator_games is None or user_games is None:
+        return make_response('Invalid game id', 400)
+
+    initiator = database.users.find_one({'steam_id': steam_id}, TRADE_MATCHER_FIELDS)
+    partner = database.users.find_one({'steam_id': user_id}, TRADE_MATCHER_FIELDS)
+
+    if initiator is None or partner is None:
+        return make_response('User not found', 404)
+
+    # each side can only hand over games they own
+    if not set(initiator_games) <= set(user_haves(initiator)) or not set(user_games) <= set(user_haves(partner)):
+        return make_response('Game not owned', 400)
+
     tradeData = {
         'initiator_id': steam_id,
         'user_id': user_id,
+        'initiator_games': initiator_games,
+        'user_games': user_games,
         'timestamp': datetime.datetime.now(),
         'accepted': False,
         'initiator_rated': False,
@@ -695,6 +959,9 @@ def trade():
     return make_response('OK', 200)
     
 
+threading.Thread(target=load_trade_matcher, daemon=True).start()
+threading.Thread(target=refresh_recommendations, daemon=True).start()
+
 if __name__ == '__main__':
     app.run(port=80, host="127.0.0.1", debug=True) 
 
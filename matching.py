@@ -0,0 +1,183 @@
+import threading
+import numpy as np
+
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+
+def to_app_array(app_ids):
+    return np.unique(np.fromiter((int(app_id) for app_id in app_ids), dtype=np.int32))
+
+
+def user_haves(user):
+    # the synced Steam library adjusted by trades completed since that sync
+    traded_out = {int(app_id) for app_id in user.get('traded_out', [])}
+    haves = [game['app_id'] for game in user.get('games', [])] + user.get('traded_in', [])
+    return [app_id for app_id in haves if int(app_id) not in traded_out]
+
+
+def build_postings(app_arrays):
+    # invert slot -> app_ids into app_id -> sorted slots in one pass
+    lengths = np.fromiter((len(apps) for apps in app_arrays), dtype=np.int64, count=len(app_arrays))
+    if not lengths.sum():
+        return {}
+
+    apps = np.concatenate(app_arrays)
+    slots = np.repeat(np.arange(len(app_arrays), dtype=np.int32), lengths)
+    # a stable sort keeps the slots of every app in ascending order
+    order = np.argsort(apps, kind='stable')
+    apps, slots = apps[order], slots[order]
+
+    app_ids, starts = np.unique(apps, return_index=True)
+    return dict(zip(app_ids.tolist(), np.split(slots, starts[1:])))
+
+
+class TradeMatcher:
+    """In-memory have/want index used to rank mutual trade partners.
+
+    Every user gets a dense slot; their haves and wants are kept as sorted int32 arrays
+    of app_ids, and every app_id keeps a sorted int32 array of the slots that own or
+    want it.
+
+    The index lives in the memory of a single process, so it assumes the site runs as
+    one process. Updates made while the initial load is running are queued and applied
+    once it finishes.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._slots = {}
+        self._steam_ids = []
+        self._haves = []
+        self._wants = []
+        self._owners = {}
+        self._wanters = {}
+
+    def load(self, users):
+        # build the index without the lock, the users cursor may take a while
+        slots = {}
+        steam_ids = []
+        haves = []
+        wants = []
+        for user in users:
+            have_ids = to_app_array(user_haves(user))
+            want_ids = np.setdiff1d(to_app_array(user.get('wants', [])), have_ids, assume_unique=True)
+
+            slots[user['steam_id']] = len(steam_ids)
+            steam_ids.append(user['steam_id'])
+            haves.append(have_ids)
+            wants.append(want_ids)
+
+        owners = build_postings(haves)
+        wanters = build_postings(wants)
+
+        with self._lock:
+            self._slots = slots
+            self._steam_ids = steam_ids
+            self._haves = haves
+            self._wants = wants
+            self._owners = owners
+            self._wanters = wanters
+
+            for steam_id, (have_ids, want_ids) in self._pending.items():
+                self._update(steam_id, have_ids, want_ids)
+            self._pending = {}
+            self.loaded = True
+
+    def update_user(self, steam_id, haves, wants):
+        with self._lock:
+            if not self.loaded:
+                self._pending[steam_id] = (list(haves), list(wants))
+                return
+            self._update(steam_id, haves, wants)
+
+    def remove_user(self, steam_id):
+        with self._lock:
+            if not self.loaded:
+                self._pending[steam_id] = ([], [])
+            elif steam_id in self._slots:
+                self._update(steam_id, [], [])
+
+    def _update(self, steam_id, haves, wants):
+        slot = self._slots.get(steam_id)
+        if slot is None:
+            slot = len(self._steam_ids)
+            self._slots[steam_id] = slot
+            self._steam_ids.append(steam_id)
+            self._haves.append(EMPTY)
+            self._wants.append(EMPTY)
+
+        haves = to_app_array(haves)
+        # nobody needs to trade for a game they already own
+        wants = np.setdiff1d(to_app_array(wants), haves, assume_unique=True)
+
+        self._apply(slot, self._haves[slot], haves, self._owners)
+        self._apply(slot, self._wants[slot], wants, self._wanters)
+        self._haves[slot] = haves
+        self._wants[slot] = wants
+
+    @staticmethod
+    def _apply(slot, old, new, index):
+        for app_id in np.setdiff1d(old, new, assume_unique=True).tolist():
+            postings = index[app_id]
+            postings = np.delete(postings, np.searchsorted(postings, slot))
+            if len(postings):
+                index[app_id] = postings
+            else:
+                del index[app_id]
+        for app_id in np.setdiff1d(new, old, assume_unique=True).tolist():
+            postings = index.get(app_id, EMPTY)
+            index[app_id] = np.insert(postings, np.searchsorted(postings, slot), slot)
+
+    @staticmethod
+    def _postings(app_ids, index):
+        return [index[app_id] for app_id in app_ids.tolist() if app_id in index]
+
+    def best_partners(self, steam_id, k=10):
+        """Return the top k users who own what steam_id wants and want what steam_id owns.
+
+        Partners are ranked by the number of games that could change hands both ways,
+        then by the total number of matching games.
+        """
+        with self._lock:
+            slot = self._slots.get(steam_id)
+            if slot is None:
+                return []
+
+            haves = self._haves[slot]
+            wants = self._wants[slot]
+            user_count = len(self._steam_ids)
+            # how many of my wants each user owns, and how many of their wants I own
+            receive_postings = self._postings(wants, self._owners)
+            offer_postings = self._postings(haves, self._wanters)
+
+            if not receive_postings or not offer_postings:
+                return []
+
+            receive = np.bincount(np.concatenate(receive_postings), minlength=user_count)
+            offer = np.bincount(np.concatenate(offer_postings), minlength=user_count)
+
+            mutual = np.minimum(receive, offer)
+            mutual[slot] = 0
+            candidates = np.flatnonzero(mutual)
+
+            if len(candidates) > k:
+                # rank on a single key: mutual count first, total matches as tie-breaker
+                scores = mutual[candidates] * (len(wants) + len(haves) + 1) + receive[candidates] + offer[candidates]
+                candidates = candidates[np.argpartition(-scores, k - 1)[:k]]
+
+            candidates = candidates[np.lexsort((
+                -(receive[candidates] + offer[candidates]),
+                -mutual[candidates],
+            ))]
+
+            partners = []
+            for candidate in candidates.tolist():
+                partners.append({
+                    'steam_id': self._steam_ids[candidate],
+                    'receive': np.intersect1d(wants, self._haves[candidate], assume_unique=True).tolist(),
+                    'offer': np.intersect1d(haves, self._wants[candidate], assume_unique=True).tolist(),
+                })
+            return partners
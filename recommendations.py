@@ -0,0 +1,196 @@
+import datetime
+from decouple import config
+import numpy as np
+import pymongo
+from scipy import sparse
+
+
+mongodb = pymongo.MongoClient(config("MONGO_URI"))
+database = mongodb.game_shifters
+
+MOST_OFFERED_ID = 'most_offered'
+TOP_COUNT = 26
+# similar games kept per game, the rest of the co-ownership row is discarded
+NEIGHBOUR_COUNT = 50
+ITEM_BATCH_SIZE = 256
+USER_BATCH_SIZE = 1024
+
+
+def load_ownership():
+    users = list(database.users.find({}, {'_id': 0, 'steam_id': 1, 'games.app_id': 1}))
+    steam_ids = [user['steam_id'] for user in users]
+
+    rows = []
+    app_ids = []
+    for row, user in enumerate(users):
+        for game in user.get('games', []):
+            rows.append(row)
+            app_ids.append(int(game['app_id']))
+
+    # map the sparse app_id space onto dense matrix columns
+    apps, columns = np.unique(np.array(app_ids, dtype=np.int64), return_inverse=True)
+
+    ownership = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (np.array(rows, dtype=np.int64), columns)),
+        shape=(len(users), len(apps)),
+    )
+    # duplicate library entries would otherwise count twice
+    ownership.data[:] = 1
+    return steam_ids, apps, ownership
+
+
+def load_trade_counts(steam_ids):
+    trades = database.trades.aggregate([
+        {
+            '$match': {
+                'completed': True
+            }
+        }, {
+            '$project': {
+                'steam_id': ['$initiator_id', '$user_id']
+            }
+        }, {
+            '$unwind': '$steam_id'
+        }, {
+            '$group': {
+                '_id': '$steam_id',
+                'count': {
+                    '$sum': 1
+                }
+            }
+        }
+    ])
+    counts = {trade['_id']: trade['count'] for trade in trades}
+    return np.array([counts.get(steam_id, 0) for steam_id in steam_ids], dtype=np.float32)
+
+
+def item_similarity(ownership, neighbours=NEIGHBOUR_COUNT, batch_size=ITEM_BATCH_SIZE):
+    # cosine similarity between the ownership columns of every pair of games, computed a
+    # block of games at a time so the full game x game co-ownership matrix never exists
+    app_count = ownership.shape[1]
+    owners = np.asarray(ownership.sum(axis=0)).ravel()
+    norms = np.sqrt(owners)
+    norms[norms == 0] = 1
+
+    transposed = ownership.T.tocsr()
+    columns = ownership.tocsc()
+
+    rows, cols, values = [], [], []
+    for start in range(0, app_count, batch_size):
+        stop = min(start + batch_size, app_count)
+        block = (transposed @ columns[:, start:stop]).tocsc()
+
+        for offset in range(stop - start):
+            app = start + offset
+            neighbour_ids = block.indices[block.indptr[offset]:block.indptr[offset + 1]]
+            similarity = block.data[block.indptr[offset]:block.indptr[offset + 1]] / (norms[neighbour_ids] * norms[app])
+
+            keep = neighbour_ids != app
+            neighbour_ids, similarity = neighbour_ids[keep], similarity[keep]
+            if len(neighbour_ids) > neighbours:
+                best = np.argpartition(-similarity, neighbours - 1)[:neighbours]
+                neighbour_ids, similarity = neighbour_ids[best], similarity[best]
+
+            # row i, column j: game i is one of the nearest neighbours of game j
+            rows.append(neighbour_ids)
+            cols.append(np.full(len(neighbour_ids), app, dtype=np.int64))
+            values.append(similarity.astype(np.float32))
+
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(app_count, app_count),
+    )
+
+
+def most_offered(ownership, trade_counts):
+    # games held by users who actually complete trades are more likely to be on offer
+    weights = 1 + trade_counts
+    offer_scores = ownership.T @ weights
+    offers = np.asarray(ownership.sum(axis=0)).ravel()
+    return offer_scores, offers
+
+
+def top_indices(columns, scores, count):
+    if len(columns) > count:
+        best = np.argpartition(-scores, count - 1)[:count]
+        columns, scores = columns[best], scores[best]
+    return columns[np.argsort(-scores, kind='stable')]
+
+
+def trade_for(ownership, similarity, count=TOP_COUNT, batch_size=USER_BATCH_SIZE):
+    # score every game by its similarity to the user's library; a game reachable through
+    # co-ownership always has at least one other owner who could hand it over
+    recommendations = []
+    for start in range(0, ownership.shape[0], batch_size):
+        users = ownership[start:start + batch_size]
+        scores = (users @ similarity).tocsr()
+
+        for row in range(users.shape[0]):
+            columns = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+            values = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+
+            owned = users.indices[users.indptr[row]:users.indptr[row + 1]]
+            keep = ~np.isin(columns, owned) & (values > 0)
+            recommendations.append(top_indices(columns[keep], values[keep], count))
+    return recommendations
+
+
+def get_game_documents(app_ids):
+    apps = database.apps.find(
+        {'app_id': {'$in': [int(app_id) for app_id in app_ids]}},
+        {'_id': 0, 'app_id': 1, 'name': 1, 'header_image': 1, 'rating': 1}
+    )
+    return {app['app_id']: app for app in apps}
+
+
+def build_games(apps, indices, app_ids, offers):
+    games = []
+    for index in indices:
+        app = apps.get(int(app_ids[index]))
+        if app:
+            games.append(dict(app, offers=int(offers[index])))
+    return games
+
+
+def update_recommendations():
+    steam_ids, app_ids, ownership = load_ownership()
+    generated_at = datetime.datetime.now()
+
+    if not steam_ids or not len(app_ids):
+        database.recommendations.drop()
+        return
+
+    trade_counts = load_trade_counts(steam_ids)
+    offer_scores, offers = most_offered(ownership, trade_counts)
+    similarity = item_similarity(ownership)
+
+    top = top_indices(np.arange(len(app_ids)), offer_scores, TOP_COUNT)
+    recommendations = trade_for(ownership, similarity)
+
+    needed = np.unique(np.concatenate([top] + recommendations)).astype(np.int64)
+    apps = get_game_documents(app_ids[needed])
+
+    documents = [{
+        '_id': MOST_OFFERED_ID,
+        'games': build_games(apps, top, app_ids, offers),
+        'generated_at': generated_at,
+    }]
+    for steam_id, indices in zip(steam_ids, recommendations):
+        documents.append({
+            '_id': steam_id,
+            'games': build_games(apps, indices, app_ids, offers),
+            'generated_at': generated_at,
+        })
+
+    # build the new set aside and swap it in, so / never sees a missing or half written one
+    database.recommendations_new.drop()
+    database.recommendations_new.insert_many(documents)
+    database.recommendations_new.rename('recommendations', dropTarget=True)
+    # the live top100in2weeks list this replaced, no longer read by anything
+    database.top_games.drop()
+
+
+# main.py rebuilds the recommendations every RECOMMENDATIONS_INTERVAL seconds,
+# run this file directly to rebuild them by hand
+if __name__ == '__main__':
+    update_recommendations()
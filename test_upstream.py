@@ -0,0 +1,141 @@
+import threading
+import time
+import pytest
+import requests
+from upstream import CircuitBreaker, CircuitOpenError, Upstream, UpstreamBusyError, UpstreamError, describe
+
+
+def fail():
+    raise ValueError('boom')
+
+
+def test_opens_after_consecutive_failures():
+    upstream = Upstream('test', timeout=1, failure_threshold=3)
+
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            upstream.call(fail)
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+    with pytest.raises(UpstreamError):
+        upstream.call(fail)
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        upstream.call(lambda: 1)
+
+
+def test_success_resets_failure_count():
+    upstream = Upstream('test', timeout=1, failure_threshold=2)
+
+    with pytest.raises(UpstreamError):
+        upstream.call(fail)
+    upstream.call(lambda: 1)
+    with pytest.raises(UpstreamError):
+        upstream.call(fail)
+
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_admits_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure(ValueError(), breaker.before_call())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() is False
+
+
+def test_failed_trial_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure(ValueError(), breaker.before_call())
+
+    time.sleep(0.06)
+    breaker.record_failure(ValueError(), breaker.before_call())
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_late_success_does_not_close_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    # admitted while the breaker was still closed
+    late = breaker.before_call()
+    breaker.record_failure(ValueError(), breaker.before_call())
+    opened_at = breaker.opened_at
+
+    breaker.record_success(late)
+    breaker.record_failure(ValueError(), late)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened_at == opened_at
+
+
+def test_budget_held_by_abandoned_calls_counts_as_failure():
+    release = threading.Event()
+    upstream = Upstream('test', timeout=0.05, max_concurrency=1, acquire_timeout=0.01, failure_threshold=2)
+
+    try:
+        with pytest.raises(UpstreamError):
+            upstream.call(release.wait)
+        assert upstream.abandoned == 1
+
+        with pytest.raises(UpstreamBusyError):
+            upstream.call(lambda: 1)
+        assert upstream.breaker.state == CircuitBreaker.OPEN
+    finally:
+        release.set()
+
+
+def test_busy_budget_of_live_calls_is_not_a_failure():
+    release = threading.Event()
+    upstream = Upstream('test', timeout=1, max_concurrency=1, acquire_timeout=0.01, failure_threshold=1)
+
+    try:
+        caller = threading.Thread(target=upstream.call, args=(release.wait,))
+        caller.start()
+        time.sleep(0.05)
+
+        with pytest.raises(UpstreamBusyError):
+            upstream.call(lambda: 1)
+        assert upstream.breaker.state == CircuitBreaker.CLOSED
+    finally:
+        release.set()
+        caller.join()
+
+
+def test_describe_redacts_query_strings():
+    error = requests.exceptions.ConnectionError(
+        "HTTPSConnectionPool(host='api.steampowered.com', port=443): Max retries exceeded with url: "
+        "/ISteamUser/GetPlayerSummaries/v2/?key=SECRETKEY&steamids=1 (Caused by NewConnectionError('refused'))"
+    )
+
+    description = describe(error)
+
+    assert 'SECRETKEY' not in description
+    assert description.startswith('ConnectionError: ')
+    assert '/ISteamUser/GetPlayerSummaries/v2/?<redacted> (Caused by' in description
+
+
+def test_client_errors_do_not_count_as_failures(monkeypatch):
+    response = requests.Response()
+    response.status_code = 400
+    monkeypatch.setattr(requests, 'get', lambda *args, **kwargs: response)
+    upstream = Upstream('test', timeout=1, failure_threshold=1)
+
+    with pytest.raises(UpstreamError):
+        upstream.get_json('https://example.com/api?key=SECRETKEY')
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+    response.status_code = 429
+    with pytest.raises(UpstreamError):
+        upstream.get_json('https://example.com/api?key=SECRETKEY')
+    assert upstream.breaker.state == CircuitBreaker.OPEN
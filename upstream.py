@@ -0,0 +1,210 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import re
+import threading
+import time
+import requests
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class UpstreamBusyError(UpstreamError):
+    pass
+
+
+class UpstreamTimeoutError(UpstreamError):
+    pass
+
+
+class UpstreamClientError(UpstreamError):
+    """The host answered, but rejected the request itself."""
+
+
+def describe(error):
+    # urls in request errors carry the API key in their query string
+    message = re.sub(r'\?[^\s)\'"]*', '?<redacted>', str(error))
+    return f'{type(error).__name__}: {message}'
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and rejects calls until
+    reset_timeout has passed, then lets a single trial call through (half open).
+    Only the outcome of that trial call closes or reopens the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call may not go ahead, otherwise return
+        whether it is the trial call of a half open breaker.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('circuit is open')
+                self.state = self.HALF_OPEN
+
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    raise CircuitOpenError('circuit is half open')
+                self._trial_running = True
+                return True
+
+            return False
+
+    def release_trial(self, trial):
+        if trial:
+            with self._lock:
+                self._trial_running = False
+
+    def record_success(self, trial):
+        with self._lock:
+            if self.state == self.HALF_OPEN and trial:
+                self.state = self.CLOSED
+                self.opened_at = None
+                self._trial_running = False
+                self.failures = 0
+            elif self.state == self.CLOSED:
+                self.failures = 0
+
+    def record_failure(self, error, trial):
+        with self._lock:
+            self.last_error = describe(error)
+
+            if self.state == self.HALF_OPEN and trial:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+            elif self.state == self.CLOSED:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.state = self.OPEN
+                    self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': round(max(0, self.reset_timeout - (time.monotonic() - self.opened_at)), 2) if self.opened_at else 0,
+                'last_error': self.last_error,
+            }
+
+
+class Upstream:
+    """A remote host guarded by a circuit breaker, a per-call timeout and a bounded
+    number of concurrent calls, so a slow host cannot tie up every web worker.
+    """
+
+    def __init__(self, name, timeout=5, max_concurrency=8, acquire_timeout=0.5,
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.acquire_timeout = acquire_timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.in_flight = 0
+        # calls the caller gave up on that still hold their slot
+        self.abandoned = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._counter_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix=name)
+
+    def _release(self, future):
+        with self._counter_lock:
+            self.in_flight -= 1
+            if getattr(future, 'abandoned', False):
+                self.abandoned -= 1
+        self._slots.release()
+
+    def call(self, func, *args, **kwargs):
+        return self.call_waiting(self.acquire_timeout, func, *args, **kwargs)
+
+    def call_waiting(self, acquire_timeout, func, *args, **kwargs):
+        """Like call, but waits up to acquire_timeout for a free slot. Batch callers
+        use it to queue for the budget instead of being turned away.
+        """
+        trial = self.breaker.before_call()
+
+        if not self._slots.acquire(timeout=acquire_timeout):
+            with self._counter_lock:
+                self.rejected += 1
+                hung = self.abandoned >= self.max_concurrency
+
+            error = UpstreamBusyError(f'{self.name} is busy')
+            # callers merely queueing is not the host's fault, a budget held
+            # entirely by calls that already timed out is
+            if hung:
+                self.breaker.record_failure(error, trial)
+            else:
+                self.breaker.release_trial(trial)
+            raise error
+
+        with self._counter_lock:
+            self.in_flight += 1
+
+        # the slot is only freed once the call really finishes, even if we stopped waiting
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._release)
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._counter_lock:
+                if not future.done():
+                    future.abandoned = True
+                    self.abandoned += 1
+            error = UpstreamTimeoutError(f'{self.name} timed out after {self.timeout}s')
+            self.breaker.record_failure(error, trial)
+            raise error
+        except UpstreamClientError:
+            # the host is up and answering, the request was at fault
+            self.breaker.record_success(trial)
+            raise
+        except Exception as e:
+            self.breaker.record_failure(e, trial)
+            raise UpstreamError(f'{self.name} failed: {describe(e)}') from None
+
+        self.breaker.record_success(trial)
+        return result
+
+    def _get_json(self, url, params=None):
+        response = requests.get(url, params=params, timeout=self.timeout)
+        # too many requests is the host struggling, any other 4xx is our mistake
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise UpstreamClientError(f'{self.name} answered {response.status_code}')
+        response.raise_for_status()
+        return response.json()
+
+    def get_json(self, url, params=None, acquire_timeout=None):
+        if acquire_timeout is None:
+            acquire_timeout = self.acquire_timeout
+        return self.call_waiting(acquire_timeout, self._get_json, url, params)
+
+    def snapshot(self):
+        snapshot = self.breaker.snapshot()
+        with self._counter_lock:
+            snapshot['in_flight'] = self.in_flight
+            snapshot['abandoned'] = self.abandoned
+            snapshot['rejected'] = self.rejected
+        snapshot['max_concurrency'] = self.max_concurrency
+        snapshot['timeout'] = self.timeout
+        return snapshot